@@ -3,51 +3,572 @@ Contains functionality for creating PyTorch DataLoaders for
 image classification data.
 """
 
+import contextlib
+import json
 import os
+import shutil
+import stat
+import tempfile
+import threading
 import zipfile
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from typing import Callable
+from urllib.parse import urlparse
 from torchvision import datasets, transforms
 from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+
+import torch
 
 import requests
 
-NUM_WORKERS = os.cpu_count()
+# accimage decodes JPEGs with Intel IPP, which is a lot faster than stock Pillow.
+# It is optional, Pillow-SIMD is the other drop-in option and needs no code change.
+try:
+  import accimage
+except ImportError:
+  accimage = None
+
+# stream-unzip lets download_zip_data unzip straight from the HTTP response
+try:
+  from stream_unzip import stream_unzip
+except ImportError:
+  stream_unzip = None
+
+def _default_workers():
+  """Returns the default number of worker processes.
+
+  Counts the CPUs this process may run on (containers and SLURM jobs often get
+  only a few cores of a big host), capped at 8: DataLoader throughput peaks at a
+  handful of workers and drops again as more processes compete for memory and IPC.
+  """
+  if hasattr(os, "sched_getaffinity"):
+    n_cpus = len(os.sched_getaffinity(0))
+  else:
+    n_cpus = os.cpu_count() or 1
+  return min(8, n_cpus)
+
+
+NUM_WORKERS = _default_workers()
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+# stream-unzip works best with small network chunks
+STREAM_CHUNK_SIZE = 64 * 1024
+# Files smaller than this are not worth splitting into Range requests
+RANGE_MIN_SIZE = 16 * 1024 * 1024
+
+def _ranged_size(data_source_pth: str):
+  """
+    Returns the size and version of a remote file if it can be downloaded in parts.
+
+    Args:
+      data_source_pth: URL of the file
+
+    Returns:
+      A tuple of (size, validator). size is the Content-Length in bytes, or
+      None if the server doesn't accept byte Range requests or the size is
+      unknown. validator is the strong ETag, or else the Last-Modified date,
+      that identifies this version of the file (None if there is neither).
+  """
+  try:
+    r = requests.head(data_source_pth, allow_redirects=True, timeout=30)
+  except requests.RequestException:
+    return None, None
+  # With a Content-Encoding the byte ranges would refer to the compressed body
+  if (not r.ok or r.headers.get("Accept-Ranges", "").lower() != "bytes"
+      or r.headers.get("Content-Encoding") or "Content-Length" not in r.headers):
+    return None, None
+  # If-Range only accepts strong ETags
+  etag = r.headers.get("ETag")
+  if etag is not None and etag.startswith("W/"):
+    etag = None
+  return int(r.headers["Content-Length"]), etag or r.headers.get("Last-Modified")
+
+
+def _download_range(data_source_pth: str,
+                    fd: int,
+                    start: int,
+                    end: int,
+                    chunk_size: int,
+                    validator: str=None,
+                    stop: threading.Event=None):
+  """
+    Downloads bytes start..end (inclusive) of a file and writes them at the same offset of fd.
+
+    Args:
+      data_source_pth: URL of the file
+      fd: File descriptor of the output file
+      start: First byte of the range
+      end: Last byte of the range
+      chunk_size: Number of bytes read from the response at a time
+      validator: ETag or Last-Modified of the expected file version, sent as
+        If-Range so a changed file comes back whole (200) instead of as a part
+      stop: Event that is set when another part failed, the download then
+        returns early without finishing this part
+  """
+  headers = {"Range": f"bytes={start}-{end}"}
+  if validator is not None:
+    headers["If-Range"] = validator
+  with requests.get(data_source_pth, headers=headers, stream=True, timeout=30) as r:
+      r.raise_for_status()
+      if r.status_code != 206:
+        raise RuntimeError(f"Server ignored the Range request for {data_source_pth} "
+                           f"(or the file changed during the download)")
+      etag = r.headers.get("ETag")
+      if validator is not None and etag is not None and validator.startswith('"') and etag != validator:
+        raise RuntimeError(f"{data_source_pth} changed during the download")
+      offset = start
+      for chunk in r.iter_content(chunk_size=chunk_size):
+          if stop is not None and stop.is_set():
+            return
+          os.pwrite(fd, chunk, offset)
+          offset += len(chunk)
+  if offset != end + 1:
+    raise RuntimeError(f"Incomplete download of bytes {start}-{end} from {data_source_pth}")
+
 
 def download_data(target_dir_pth: Path, 
-                  data_source_pth: str):
+                  data_source_pth: str,
+                  chunk_size: int=1024 * 1024,
+                  num_connections: int=4):
   """
     Used to download files (Ex: csv) 
+
+    The response is streamed to disk chunk by chunk, so large files are
+    never held in memory at once. Chunks are collected in an 8 MiB write
+    buffer so the disk sees a few large writes instead of many small ones.
+
+    Large files (16 MiB or more) from servers that accept byte Range
+    requests are split into num_connections parts that are downloaded in
+    parallel and written straight to their offset in the output file.
+
+    The data is written to a temporary .part file next to target_dir_pth,
+    which is only renamed to target_dir_pth once the whole download succeeded.
     
     Args:
       target_dir_pth: Path where the file will be downloaded to
       data_source_pth: String which the path to the data (Ex: https://raw.githubusercontent.com/DanielSzakacs/dogImages/main/labels.csv)
+      chunk_size: Number of bytes read from the response at a time. Defaults to 1 MiB.
+      num_connections: Number of parallel connections for large files. Defaults to 4.
   """
   print(f"[INFO] Download data from {data_source_pth}")
-  with open(target_dir_pth, "wb") as f: 
-      request = requests.get(data_source_pth)
-      f.write(request.content)
-      print(f"[INFO] Done")
+  size, validator = None, None
+  if num_connections > 1 and hasattr(os, "pwrite"):
+    size, validator = _ranged_size(data_source_pth)
+
+  tmp_path = f"{target_dir_pth}.{os.getpid()}.part"
+  try:
+    with open(tmp_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+      if size is not None and size >= RANGE_MIN_SIZE:
+        part_size = -(-size // num_connections)
+        # Allocate the full file up front, every part writes into its own slice
+        f.truncate(size)
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=num_connections) as executor:
+            futures = [executor.submit(_download_range, data_source_pth, f.fileno(),
+                                       start, min(start + part_size, size) - 1, chunk_size,
+                                       validator, stop)
+                       for start in range(0, size, part_size)]
+            try:
+                # Take the results as they finish so the first failure is seen right away
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                # Stop the other parts instead of waiting for them to download (also on Ctrl-C)
+                stop.set()
+                for future in futures:
+                    future.cancel()
+                raise
+      else:
+        with requests.get(data_source_pth, stream=True, timeout=30) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+    os.replace(tmp_path, target_dir_pth)
+  except BaseException:
+    # Never leave a half-written (or zero-filled) file behind. If opening the
+    # .part file failed there is nothing to remove, keep the original error.
+    with contextlib.suppress(FileNotFoundError):
+      os.unlink(tmp_path)
+    raise
+  print(f"[INFO] Done")
+
+
+def _member_target(target_path: Path,
+                   name: str):
+   """
+    Returns where a zip entry should be written to.
+
+    Args:
+        target_path: (Path) Directory the entry is extracted under, already
+          resolved (callers resolve it once per archive, not once per entry)
+        name: (str) Name of the entry inside the zip file
+   """
+   # A lexical check is enough: the extraction only writes regular files and
+   # directories, never symlinks, so no entry can redirect a later one
+   target = os.path.normpath(os.path.join(target_path, name))
+   # Refuse entries like "../../etc/passwd" that would land outside target_path
+   if os.path.commonpath([target_path, target]) != os.fspath(target_path):
+      raise ValueError(f"Unsafe path in zip file: {name}")
+   return Path(target)
+
+
+def _extract_member(zip_ref: zipfile.ZipFile,
+                    info: zipfile.ZipInfo,
+                    target_path: Path):
+   """
+    Streams a single zip entry to disk in fixed-size chunks.
+
+    Args:
+        zip_ref: (ZipFile) Opened archive the entry belongs to
+        info: (ZipInfo) Entry to extract
+        target_path: (Path) Directory the entry is extracted under
+   """
+   target = _member_target(target_path, info.filename)
+   if info.is_dir():
+      target.mkdir(parents=True, exist_ok=True)
+      return
+   target.parent.mkdir(parents=True, exist_ok=True)
+   with zip_ref.open(info) as src, open(target, "wb", buffering=COPY_BUFFER_SIZE) as dst:
+      shutil.copyfileobj(src, dst, length=COPY_BUFFER_SIZE)
+
+
+def _extract_chunk(source: str,
+                   target_path: Path,
+                   names: list):
+   """
+    Extracts a subset of zip entries. Runs inside a worker thread.
+
+    Every worker opens its own ZipFile handle, an open archive keeps a
+    single file position and decompressor state that threads can't share.
+
+    Args:
+        source: (str) Path to the zip file
+        target_path: (Path) Directory the entries are extracted under
+        names: (list) Names of the entries to extract
+   """
+   with zipfile.ZipFile(source, "r") as r:
+      for name in names:
+         _extract_member(r, r.getinfo(name), target_path)
+
+
+def _extract_zip(source: str,
+                 target_path: Path,
+                 num_workers: int):
+   """
+    Extracts a local zip file, split between num_workers threads.
+
+    zlib releases the GIL while decompressing, so threads decompress in
+    parallel without spawning processes (which would need a __main__ guard
+    in the calling script and re-import torch in every worker).
+
+    Args:
+        source: (str) Path to the zip file
+        target_path: (Path) Where the zip file will be unzipped
+        num_workers: (int) Number of threads used for the extraction
+   """
+   target_path = Path(target_path).resolve()
+   with zipfile.ZipFile(source, "r") as r:
+      # Create the directories up front, the workers only write files
+      for info in r.infolist():
+         if info.is_dir():
+            _extract_member(r, info, target_path)
+      names = [info.filename for info in r.infolist() if not info.is_dir()]
+
+   num_workers = max(1, min(num_workers or 1, len(names)))
+   if num_workers == 1:
+      _extract_chunk(source, target_path, names)
+      return
+
+   # Round-robin the entries so large and small files spread evenly
+   chunks = [names[i::num_workers] for i in range(num_workers)]
+   with ThreadPoolExecutor(max_workers=num_workers) as executor:
+      futures = [executor.submit(_extract_chunk, source, target_path, chunk) for chunk in chunks]
+      for future in futures:
+         future.result()
+
+
+def _stream_extract(source: str,
+                    target_path: Path,
+                    chunk_size: int=STREAM_CHUNK_SIZE):
+   """
+    Unzips a remote zip file while it is being downloaded.
+
+    Nothing but the extracted files is written to disk.
+
+    Args:
+        source: (str) URL of the zip file
+        target_path: (Path) Where the zip file will be unzipped
+        chunk_size: (int) Number of bytes read from the response at a time
+   """
+   target_path = Path(target_path).resolve()
+   with requests.get(source, stream=True, timeout=30) as r:
+      r.raise_for_status()
+      for name, size, chunks in stream_unzip(r.iter_content(chunk_size=chunk_size)):
+         # Names without the zip UTF-8 flag are cp437, which is what zipfile assumes too
+         try:
+            name = name.decode("utf-8")
+         except UnicodeDecodeError:
+            name = name.decode("cp437")
+         target = _member_target(target_path, name)
+         # Every entry has to be consumed before stream-unzip moves on to the next one
+         if name.endswith("/"):
+            target.mkdir(parents=True, exist_ok=True)
+            for _ in chunks:
+               pass
+            continue
+         target.parent.mkdir(parents=True, exist_ok=True)
+         with open(target, "wb", buffering=COPY_BUFFER_SIZE) as f:
+            for chunk in chunks:
+               f.write(chunk)
+
+
+def _source_fingerprint(source: str):
+   """
+    Describes the current version of a zip file.
+
+    Args:
+        source: (str) Local path or http(s) URL of the zip file
+
+    Returns:
+        A dict with the size and the ETag/Last-Modified (URL) or modification time (local file),
+        or None if the source can't be identified.
+   """
+   if str(source).startswith(("http://", "https://")):
+      try:
+         r = requests.head(source, allow_redirects=True, timeout=30)
+      except requests.RequestException:
+         return None
+      etag = r.headers.get("ETag")
+      size = r.headers.get("Content-Length")
+      if not r.ok or (etag is None and size is None):
+         return None
+      return {"source": str(source), "etag": etag, "size": size,
+              "last_modified": r.headers.get("Last-Modified")}
+   try:
+      source_stat = os.stat(source)
+   except OSError:
+      return None
+   return {"source": os.path.abspath(source), "mtime_ns": source_stat.st_mtime_ns, "size": source_stat.st_size}
+
+
+def _unzip(source: str,
+           target_path: Path,
+           num_workers: int):
+   """
+    Unzips a local or remote zip file into target_path.
+
+    Args:
+        source: (str) Local path or http(s) URL of the zip file
+        target_path: (Path) Where the zip file will be unzipped
+        num_workers: (int) Number of threads used for the extraction
+   """
+   if str(source).startswith(("http://", "https://")):
+      if stream_unzip is not None:
+         print(f"[INFO] Downloading and unzipping {source} ...")
+         _stream_extract(source, target_path)
+         return
+      # Without stream-unzip the archive has to be on disk first
+      fd, tmp_path = tempfile.mkstemp(suffix=".zip")
+      os.close(fd)
+      try:
+         download_data(Path(tmp_path), source)
+         _extract_zip(tmp_path, target_path, num_workers)
+      finally:
+         os.remove(tmp_path)
+      return
+
+   print(f"[INFO] Downloading zip file {source} ...")
+   _extract_zip(source, target_path, num_workers)
 
 
 def download_zip_data(source: str,
-                      target_path: Path):
+                      target_path: Path,
+                      num_workers: int=None):
    """
     Download and unzip zip files
 
+    The entries are split between num_workers threads which decompress
+    them in parallel. If source is an http(s) URL and stream-unzip is
+    installed, the archive is unzipped while it downloads and never stored.
+
+    After a successful extraction a small .<zip name>.meta.json file with the
+    archive's ETag/size (or mtime/size for local files) is written to
+    target_path. If it still matches on the next call, nothing is done.
+
     Args: 
         source_path: (Path) Ex: /content/drive/MyDrive/Pytorch course/Dog_recognizer/data/train_zip.zip
+          or an http(s) URL of a zip file
         target_path: (Path) Where the zip file will be unzipped
         remove_source: (Boolean) Remove the downloaded zip file. 
+        num_workers: (int) Number of threads used for the extraction.
+          Defaults to the number of CPUs available to this process, at most 8.
    """
-    # Check is the target dir is exits
-   if target_path.is_dir() == False:
+   if num_workers is None:
+      num_workers = _default_workers()
+   target_path = Path(target_path)
+   # Check is the target dir is exits (one stat call, also catches a file in its place)
+   try:
+      target_stat = os.stat(target_path)
+   except FileNotFoundError:
+      target_stat = None
+   if target_stat is None or not stat.S_ISDIR(target_stat.st_mode):
       print(f"[INFO] Target directory do not exist...")
       return 
    else: 
-      print(f"[INFO] Downloading zip file {source} ...")
-      with zipfile.ZipFile(source, "r") as r:
-         r.extractall(target_path)
+      # Skip the work if the same archive was already fully extracted here
+      meta_path = target_path / f".{Path(urlparse(str(source)).path).name}.meta.json"
+      fingerprint = _source_fingerprint(source)
+      if fingerprint is not None and meta_path.is_file():
+         try:
+            with open(meta_path) as f:
+               if json.load(f) == fingerprint:
+                  print(f"[INFO] {source} is already extracted to {target_path}, skipping")
+                  return
+         except (OSError, ValueError):
+            pass
+
+      # Drop the old metadata first, so a crash during extraction never looks complete
+      meta_path.unlink(missing_ok=True)
+      _unzip(source, target_path, num_workers)
+      if fingerprint is not None:
+         with open(meta_path, "w") as f:
+            json.dump(fingerprint, f)
+
+
+def _channels_last_collate(batch):
+  """Collates a batch and stores the images in channels_last (NHWC) memory format."""
+  X, y = default_collate(batch)
+  return X.contiguous(memory_format=torch.channels_last), y
+
+
+def _scan_images(directory: str,
+                 extensions: tuple,
+                 class_index: int,
+                 samples: list,
+                 dirs: list=None):
+  """Recursively appends (path, class_index) for every image below directory.
+
+  Uses os.scandir, whose entries already know whether they are directories,
+  so no extra stat call is needed per file. If dirs is given, a
+  (path, mtime_ns) pair is appended to it for every directory visited.
+
+  The order is the same as torchvision's make_dataset: directories sorted by
+  their full path (like sorted(os.walk(...))), files sorted by name inside each.
+  """
+  found = []
+  pending = [directory]
+  while pending:
+    current = pending.pop()
+    if dirs is not None:
+      # Stat before listing, so files added during the scan make the mtime stale
+      dirs.append((current, os.stat(current).st_mtime_ns))
+    fnames = []
+    for entry in os.scandir(current):
+      # is_dir() follows symlinks, like os.walk(followlinks=True) in ImageFolder
+      if entry.is_dir():
+        pending.append(entry.path)
+      elif entry.name.lower().endswith(extensions):
+        fnames.append(entry.name)
+    found.append((current, fnames))
+
+  for current, fnames in sorted(found):
+    for fname in sorted(fnames):
+      samples.append((os.path.join(current, fname), class_index))
+
+
+class FastImageFolder(datasets.ImageFolder):
+  """ImageFolder that lists the image files with os.scandir.
+
+  Gives the same samples as ImageFolder. A custom is_valid_file still goes
+  through the original ImageFolder logic.
+  """
+
+  def make_dataset(self, directory, class_to_idx, extensions=None, is_valid_file=None, **kwargs):
+    if is_valid_file is not None or extensions is None:
+      return super().make_dataset(directory, class_to_idx, extensions=extensions,
+                                  is_valid_file=is_valid_file, **kwargs)
+    return self._scan_dataset(directory, class_to_idx, extensions,
+                              kwargs.get("allow_empty", False))
+
+  @staticmethod
+  def _scan_dataset(directory, class_to_idx, extensions, allow_empty, dirs=None):
+    directory = os.path.expanduser(os.fspath(directory))
+    extensions = (extensions,) if isinstance(extensions, str) else tuple(extensions)
+    extensions = tuple(ext.lower() for ext in extensions)
+
+    samples = []
+    empty_classes = []
+    for target_class in sorted(class_to_idx):
+      target_dir = os.path.join(directory, target_class)
+      n_samples = len(samples)
+      if os.path.isdir(target_dir):
+        _scan_images(target_dir, extensions, class_to_idx[target_class], samples, dirs)
+      if len(samples) == n_samples:
+        empty_classes.append(target_class)
+
+    # Same check and message as torchvision's make_dataset
+    if empty_classes and not allow_empty:
+      raise FileNotFoundError(f"Found no valid file for the classes {', '.join(sorted(empty_classes))}. "
+                              f"Supported extensions are: {', '.join(extensions)}")
+    return samples
+
+
+class CachedImageFolder(FastImageFolder):
+  """ImageFolder that caches its list of samples on disk.
+
+  Walking a large dataset directory takes a lot of system calls. The list of
+  (path, class_index) samples is stored as JSON next to the data directory
+  (data/train -> data/.train.imagefolder_cache.json) and reused as long as the
+  directory, its classes and extensions match and the modification times of
+  every folder below it are unchanged. A custom is_valid_file skips the cache.
+  """
+
+  def make_dataset(self, directory, class_to_idx, extensions=None, is_valid_file=None, **kwargs):
+    # An arbitrary is_valid_file function can't be part of the cache key
+    if is_valid_file is not None or extensions is None:
+      return super().make_dataset(directory, class_to_idx, extensions=extensions,
+                                  is_valid_file=is_valid_file, **kwargs)
+
+    directory = os.path.expanduser(os.fspath(directory))
+    root = os.path.abspath(directory)
+    cache_path = os.path.join(os.path.dirname(root), f".{os.path.basename(root)}.imagefolder_cache.json")
+    key = {"root": root,
+           "class_to_idx": class_to_idx,
+           "extensions": [extensions] if isinstance(extensions, str) else list(extensions),
+           "allow_empty": kwargs.get("allow_empty", False)}
+
+    # JSON rather than pickle: the cache sits next to data that may come from an
+    # untrusted archive, and loading it must never run code
+    try:
+      with open(cache_path) as f:
+        cache = json.load(f)
+      # Adding or removing an entry changes the mtime of the folder it is in
+      if cache["key"] == key and all(os.stat(os.path.join(root, d)).st_mtime_ns == mtime
+                                     for d, mtime in cache["mtimes"].items()):
+        # Paths are cached relative to the root, rebuild them the way they were asked for
+        return [(os.path.join(directory, path), class_index) for path, class_index in cache["samples"]]
+    except (OSError, ValueError, KeyError, TypeError):
+      pass
+
+    dirs = [(root, os.stat(root).st_mtime_ns)]
+    samples = self._scan_dataset(directory, class_to_idx, extensions, key["allow_empty"], dirs)
+
+    # Write to a temporary file first so a concurrent run never reads half a cache
+    try:
+      tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+      with open(tmp_path, "w") as f:
+        json.dump({"key": key,
+                     "mtimes": {os.path.relpath(d, directory): mtime for d, mtime in dirs},
+                     "samples": [(os.path.relpath(path, directory), class_index)
+                                 for path, class_index in samples]}, f)
+      os.replace(tmp_path, cache_path)
+    except OSError:
+      # Read-only dataset location, just skip the cache
+      pass
+    return samples
 
 
 def create_dataloaders(
@@ -55,7 +576,12 @@ def create_dataloaders(
     test_dir: str,
     transform: transforms.Compose,
     batch_size: int,
-    num_workers: int=NUM_WORKERS
+    num_workers: int=None,
+    persistent_workers: bool=True,
+    prefetch_factor: int=2,
+    loader: Callable=None,
+    channels_last: bool=False,
+    cache_index: bool=True
 ):
   """Creates training and testing DataLoaders.
 
@@ -68,6 +594,17 @@ def create_dataloaders(
     transform: torchvision transforms to perform on training and testing data.
     batch_size: Number of samples per batch in each of the DataLoaders.
     num_workers: An integer for number of workers per DataLoader.
+      Defaults to the number of CPUs available to this process, at most 8.
+    persistent_workers: Keep the worker processes alive between epochs
+      instead of re-spawning them. Ignored when num_workers is 0.
+    prefetch_factor: Number of batches loaded in advance by each worker.
+      Ignored when num_workers is 0.
+    loader: Function that loads an image given its path. Defaults to the
+      accimage loader when accimage is installed, otherwise to Pillow.
+    channels_last: Return image batches in channels_last (NHWC) memory format.
+      Use together with utils.to_channels_last(model).
+    cache_index: Cache the list of image files next to each data directory
+      so later runs don't have to walk the directory tree again.
 
   Returns:
     A tuple of (train_dataloader, test_dataloader, class_names).
@@ -80,13 +617,30 @@ def create_dataloaders(
                              batch_size=32,
                              num_workers=4)
   """
+  if num_workers is None:
+    num_workers = _default_workers()
+
+  # Pick the fastest available image decoder
+  if loader is None:
+    loader = datasets.folder.accimage_loader if accimage is not None else datasets.folder.pil_loader
+
   # Use ImageFolder to create dataset(s)
-  train_data = datasets.ImageFolder(train_dir, transform=transform)
-  test_data = datasets.ImageFolder(test_dir, transform=transform)
+  image_folder = CachedImageFolder if cache_index else FastImageFolder
+  train_data = image_folder(train_dir, transform=transform, loader=loader)
+  test_data = image_folder(test_dir, transform=transform, loader=loader)
 
   # Get class names
   class_names = train_data.classes
 
+  # channels_last needs 4D tensors, so convert whole batches rather than single images
+  collate_fn = _channels_last_collate if channels_last else None
+
+  # Worker options are only valid when the DataLoader uses subprocesses
+  worker_kwargs = {}
+  if num_workers > 0:
+    worker_kwargs = {"persistent_workers": persistent_workers,
+                     "prefetch_factor": prefetch_factor}
+
   # Turn images into data loaders
   train_dataloader = DataLoader(
       train_data,
@@ -94,6 +648,8 @@ def create_dataloaders(
       shuffle=True,
       num_workers=num_workers,
       pin_memory=True,
+      collate_fn=collate_fn,
+      **worker_kwargs,
   )
   test_dataloader = DataLoader(
       test_data,
@@ -101,6 +657,8 @@ def create_dataloaders(
       shuffle=False,
       num_workers=num_workers,
       pin_memory=True,
+      collate_fn=collate_fn,
+      **worker_kwargs,
   )
 
   return train_dataloader, test_dataloader, class_names
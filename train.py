@@ -32,7 +32,8 @@ train_dataloader, test_dataloader, class_names = data_setup.create_dataloaders(
     train_dir=train_dir,
     test_dir=test_dir,
     transform=data_transform,
-    batch_size=BATCH_SIZE
+    batch_size=BATCH_SIZE,
+    channels_last=True
 )
 
 # Create model with help from model_builder.py
@@ -41,6 +42,7 @@ model = model_builder.TinyVGG(
     hidden_units=HIDDEN_UNITS,
     output_shape=len(class_names)
 ).to(device)
+utils.to_channels_last(model)
 
 # Set loss and optimizer
 loss_fn = torch.nn.CrossEntropyLoss()
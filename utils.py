@@ -1,19 +1,41 @@
 """
 Contains various utility functions for PyTorch model training and saving.
 """
+import functools
+
+import numpy as np
 import torch
 from pathlib import Path
 from torch import utils
 from torch.utils import tensorboard 
 from torch.utils.tensorboard import SummaryWriter
 from torchinfo import summary
+from torchvision.transforms import functional as F
+from PIL import Image
+
+
+def _is_compile_error(error):
+    """Returns True if error, or an exception it was raised from, comes from torch.compile.
+
+    The outermost torch.compile exception decides: a TorchRuntimeError only wraps
+    an ordinary error of the model's forward pass (e.g. a wrong input_size) hit
+    while tracing, so it doesn't count.
+    """
+    from torch._dynamo.exc import TorchDynamoException, TorchRuntimeError
+
+    while error is not None:
+        if isinstance(error, TorchDynamoException):
+            return not isinstance(error, TorchRuntimeError)
+        error = error.__cause__ or error.__context__
+    return False
 
 
 def model_summary(model, 
                   input_size=(1, 3, 224, 224), 
                   verbose=1, col_names=["input_size", "output_size", "num_params", "trainable"], 
                   col_width=20, 
-                  row_settings=["var_names"]):
+                  row_settings=["var_names"],
+                  compile=False):
     """
     Generates a summary of the given PyTorch model.
 
@@ -24,10 +46,18 @@ def model_summary(model,
     col_names (list): List of column names to display.
     col_width (int): Width of each column.
     row_settings (list): Row settings.
+    compile (bool): Wrap the model with torch.compile before the summary. The
+        summary's forward pass compiles the eval, no-grad graph for input_size and
+        surfaces compile errors early. The first training step still compiles
+        again (train mode, gradients, a different batch size). Use the returned
+        model for training. Compile errors are raised, not printed.
 
     Returns:
-    None
+    torch.nn.Module: The model, compiled if compile is True.
     """
+    if compile:
+      model = torch.compile(model, mode="reduce-overhead", fullgraph=False)
+
     try:
       summary(model,
             input_size=input_size,
@@ -35,8 +65,58 @@ def model_summary(model,
             col_names=col_names,
             col_width=col_width,
             row_settings=row_settings)
-    except:
-      print("[ERROR] Make sure you import summary from torchinfo. Can not display the model summary")
+    except (RuntimeError, ValueError) as e:
+      # A model that failed to compile must not be handed back for training
+      if compile and _is_compile_error(e):
+        raise
+      # torchinfo wraps errors from the forward pass (e.g. a wrong input_size) in RuntimeError
+      print(f"[ERROR] Can not display the model summary: {e}")
+
+    return model
+
+
+class FusedToNormalizedTensor:
+    """Converts a PIL image to a normalized float tensor in a single pass.
+
+    Does the same as transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean, std)]),
+    but folds the division by 255 into the normalization and does the uint8 -> float
+    conversion, scaling and shifting in a single torch.addcmul, so the float pixels
+    are written once instead of going through ToTensor and Normalize separately.
+
+    Only 8-bit PIL images take the fused path. Anything else ToTensor supports
+    (accimage images, "1", "I", "I;16" and "F" mode images, numpy arrays) goes
+    through ToTensor + Normalize, so the result is always the same.
+
+    Args:
+        mean (sequence): Mean of each channel, on the 0-1 scale used by Normalize.
+        std (sequence): Standard deviation of each channel, on the 0-1 scale.
+
+    Example usage:
+        transform = transforms.Compose([transforms.Resize((224, 224)),
+                                        FusedToNormalizedTensor(mean=[0.485, 0.456, 0.406],
+                                                                std=[0.229, 0.224, 0.225])])
+    """
+    def __init__(self, mean, std):
+        mean = torch.as_tensor(mean, dtype=torch.float32)
+        std = torch.as_tensor(std, dtype=torch.float32)
+        self.mean, self.std = mean.tolist(), std.tolist()
+        # (pixel / 255 - mean) / std == pixel * scale - shift
+        self.scale = (1.0 / (std * 255.0)).view(-1, 1, 1)
+        self.neg_shift = (-mean / std).view(-1, 1, 1)
+
+    def __call__(self, img):
+        arr = np.array(img) if isinstance(img, Image.Image) else None
+        if arr is None or arr.dtype != np.uint8:
+            return F.normalize(F.to_tensor(img), self.mean, self.std)
+        if arr.ndim == 2:
+            arr = arr[:, :, None]
+        # Read the HWC uint8 pixels and write contiguous, normalized CHW float32 in one pass
+        pixels = torch.from_numpy(arr).permute(2, 0, 1)
+        out = torch.empty(pixels.shape, dtype=torch.float32)
+        return torch.addcmul(self.neg_shift, pixels, self.scale, out=out)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(mean={self.mean}, std={self.std})"
 
 
 # Set seeds
@@ -53,15 +133,34 @@ def set_seeds(seed: int=42):
     torch.cuda.manual_seed(seed)
 
 
+@functools.lru_cache(maxsize=1)
 def set_device():
-    """ Returns the device """
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+    """ Returns the device as a torch.device. The CUDA check only runs on the first call. """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     return device
 
 
+def to_channels_last(model: torch.nn.Module):
+    """Converts the model parameters to channels_last (NHWC) memory format.
+
+    cuDNN and oneDNN have faster convolution kernels for NHWC, especially with
+    mixed precision on Tensor Cores. Feed the model channels_last batches as well,
+    see data_setup.create_dataloaders(channels_last=True).
+
+    Args:
+        model (torch.nn.Module): Model to convert.
+
+    Returns:
+        torch.nn.Module: The same model, converted in place.
+    """
+    return model.to(memory_format=torch.channels_last)
+
+
 def create_writer(experiment_name: str,
                   model_name: str,
-                  extra: str=None):
+                  extra: str=None,
+                  max_queue: int=1000,
+                  flush_secs: int=60):
     """Creates a torch.utils.tensorboard.writer.SummaryWriter() instance saving to a specific log_dir.
 
     log_dir is a combination of runs/timestamp/experiment_name/model_name/extra.
@@ -72,6 +171,9 @@ def create_writer(experiment_name: str,
         experiment_name (str): Name of experiment.
         model_name (str): Name of model.
         extra (str, optional): Anything extra to add to the directory. Defaults to None.
+        max_queue (int, optional): Number of pending events kept in memory before they are
+            written to disk. Defaults to 1000, so per-batch logging doesn't flush every few steps.
+        flush_secs (int, optional): How often, in seconds, pending events are flushed. Defaults to 60.
 
     Returns:
         torch.utils.tensorboard.writer.SummaryWriter(): Instance of a writer saving to log_dir.
@@ -97,7 +199,7 @@ def create_writer(experiment_name: str,
         log_dir = os.path.join("runs", timestamp, experiment_name, model_name)
 
     print(f"[INFO] Created SummaryWriter, saving to: {log_dir}...")
-    return SummaryWriter(log_dir=log_dir)
+    return SummaryWriter(log_dir=log_dir, max_queue=max_queue, flush_secs=flush_secs)
 
 
 
@@ -110,7 +212,9 @@ def save_model(model: torch.nn.Module,
     model: A target PyTorch model to save.
     target_dir: A directory for saving the model to.
     model_name: A filename for the saved model. Should include
-      either ".pth" or ".pt" as the file extension.
+      either ".pth", ".pt" or ".safetensors" as the file extension.
+      ".safetensors" files are written with the safetensors package
+      and can be memory-mapped when loaded.
 
     Example usage:
     save_model(model=model_0,
@@ -123,10 +227,17 @@ def save_model(model: torch.nn.Module,
                         exist_ok=True)
 
     # Create model save path
-    assert model_name.endswith(".pth") or model_name.endswith(".pt"), "model_name should end with '.pt' or '.pth'"
+    assert model_name.endswith((".pth", ".pt", ".safetensors")), "model_name should end with '.pt', '.pth' or '.safetensors'"
     model_save_path = target_dir_path / model_name
 
     # Save the model state_dict()
     print(f"[INFO] Saving model to: {model_save_path}")
-    torch.save(obj=model.state_dict(),
-             f=model_save_path)
+    if model_name.endswith(".safetensors"):
+        # save_model (unlike save_file) handles shared weights, and force_contiguous
+        # handles the non-contiguous weights of a channels_last model
+        from safetensors.torch import save_model as save_safetensors
+        save_safetensors(model, str(model_save_path), force_contiguous=True)
+    else:
+        torch.save(obj=model.state_dict(),
+                 f=model_save_path,
+                 _use_new_zipfile_serialization=True)